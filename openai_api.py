@@ -1,48 +1,63 @@
 # Requirement:
-#   pip install openai
+#   pip install openai orjson
 # Usage:
 #   python openai_api.py
+#   python openai_api.py --workers 2  # one process per GPU
 # Visit http://localhost:8000/docs for documents.
 
+import asyncio
 import base64
 import copy
+import hashlib
+import hmac
 import json
+import multiprocessing
+import os
+import re
 import time
 from argparse import ArgumentParser
-from contextlib import asynccontextmanager
-from threading import Thread
-from typing import Dict, List, Literal, Optional, Union, Any
-
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from functools import lru_cache
+from threading import Lock, Thread
+from typing import Dict, List, Literal, Optional, Tuple, Union, Any
+
+# Must be set before the first CUDA allocation. Expandable segments let the caching
+# allocator grow blocks in place, so a longer KV cache does not trigger a fresh cudaMalloc.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
+import orjson
 import torch
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from loguru import logger
-from pydantic import BaseModel, Field
+from pydantic import VERSION as PYDANTIC_VERSION, BaseModel, Field
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import Response
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers import GenerationConfig, TextIteratorStreamer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import DynamicCache, GenerationConfig, TextIteratorStreamer
+
+
+PYDANTIC_V2 = int(PYDANTIC_VERSION.split('.')[0]) >= 2
 
 
 class BasicAuthMiddleware(BaseHTTPMiddleware):
 
     def __init__(self, app, username: str, password: str):
         super().__init__(app)
-        self.required_credentials = base64.b64encode(
-            f'{username}:{password}'.encode()).decode()
+        credentials = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        # Header values are latin-1 decoded by starlette, so compare the raw bytes.
+        self.required_authorization = f'Basic {credentials}'.encode('latin-1')
 
     async def dispatch(self, request: Request, call_next):
-        authorization: str = request.headers.get('Authorization')
-        if authorization:
-            try:
-                schema, credentials = authorization.split()
-                if credentials == self.required_credentials:
-                    return await call_next(request)
-            except ValueError:
-                pass
+        authorization: str = request.headers.get('Authorization', '')
+        # Constant-time comparison of the whole header, no timing side channel on the credentials.
+        if hmac.compare_digest(authorization.encode('latin-1'), self.required_authorization):
+            return await call_next(request)
 
         headers = {'WWW-Authenticate': 'Basic'}
         return Response(status_code=401, headers=headers)
@@ -56,7 +71,9 @@ def _gc(forced: bool = False):
     import gc
 
     gc.collect()
-    if torch.cuda.is_available():
+    # Returning cached blocks to the driver makes the next request pay for cudaMalloc again,
+    # so only release them on shutdown.
+    if forced and torch.cuda.is_available():
         torch.cuda.empty_cache()
 
 
@@ -154,15 +171,57 @@ def add_extra_stop_words(stop_words):
     return _stop_words
 
 
+@lru_cache(maxsize=64)
+def _compile_stop_words(stop_words: Tuple[str, ...]):
+    # One alternation scans the text once; the leftmost match is the earliest stop word.
+    return re.compile('|'.join(re.escape(x) for x in sorted(stop_words, key=len, reverse=True)))
+
+
 def trim_stop_words(response, stop_words):
+    stop_words = tuple(x for x in stop_words if x) if stop_words else ()
     if stop_words:
-        for stop in stop_words:
-            idx = response.find(stop)
-            if idx != -1:
-                response = response[:idx]
+        match = _compile_stop_words(stop_words).search(response)
+        if match:
+            response = response[:match.start()]
     return response
 
 
+class StopWordsMatcher:
+    """Finds stop words in streamed text, including ones split across chunks."""
+
+    def __init__(self, stop_words: List[str]):
+        self.stop_words = tuple(x for x in stop_words if x)
+        self.pattern = _compile_stop_words(self.stop_words) if self.stop_words else None
+        self.max_partial_len = max((len(x) for x in self.stop_words), default=1) - 1
+        self.pending = ''
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """Returns the text that is safe to emit and whether a stop word was hit."""
+        if self.pattern is None:
+            return text, False
+        text = self.pending + text
+        match = self.pattern.search(text)
+        end = match.start() if match else len(text)
+        # Hold back the longest tail that may still turn into a stop word with the next chunk.
+        # A tail starting before a match would be an earlier stop word, so the match waits for it.
+        hold_start = end
+        for start in range(max(len(text) - self.max_partial_len, 0), end):
+            tail = text[start:]
+            if any(x.startswith(tail) for x in self.stop_words):
+                hold_start = start
+                break
+        if match and hold_start == end:
+            self.pending = ''
+            return text[:end], True
+        self.pending = text[hold_start:]
+        return text[:hold_start], False
+
+    def flush(self) -> str:
+        text, self.pending = self.pending, ''
+        # The held text may still contain a match that was waiting on a longer stop word.
+        return trim_stop_words(text, self.stop_words)
+
+
 TOOL_DESC = (
     '{name_for_model}: Call this tool to interact with the {name_for_human} API.'
     ' What is the {name_for_human} API useful for? {description_for_model} Parameters: {parameters}'
@@ -195,9 +254,10 @@ def parse_messages(messages, functions):
             detail='Invalid request: Expecting at least one user message.',
         )
 
-    messages = copy.deepcopy(messages)
+    # Caller-owned messages are only read, every message mutated below is built here.
     if messages[0].role == 'system':
-        system = messages.pop(0).content.lstrip('\n').rstrip()
+        system = messages[0].content.lstrip('\n').rstrip()
+        messages = messages[1:]
     else:
         system = 'You are a helpful assistant.'
 
@@ -218,6 +278,7 @@ def parse_messages(messages, functions):
                 #   "Format the arguments as a JSON object."
                 #   "Enclose the code within triple backticks (`) at the beginning and end of the code."
                 description_for_model=desc_m,
+                # Part of the prompt text, so keep stdlib formatting. Runs once per function, not per token.
                 parameters=json.dumps(params, ensure_ascii=False),
             )
             tools_text.append(tool)
@@ -269,9 +330,7 @@ def parse_messages(messages, functions):
             else:
                 messages[-1].content += '\n' + content
         elif role == 'user':
-            messages.append(
-                ChatMessage(role='user',
-                            content=content.lstrip('\n').rstrip()))
+            messages.append(ChatMessage(role='user', content=content))
         else:
             raise HTTPException(
                 status_code=400,
@@ -288,7 +347,7 @@ def parse_messages(messages, functions):
     history = []  # [(Q1, A1), (Q2, A2), ..., (Q_last_turn, A_last_turn)]
     for i in range(0, len(messages), 2):
         if messages[i].role == 'user' and messages[i + 1].role == 'assistant':
-            usr_msg = messages[i].content.lstrip('\n').rstrip()
+            usr_msg = messages[i].content  # already stripped above
             bot_msg = messages[i + 1].content.lstrip('\n').rstrip()
             if instruction and (i == len(messages) - 2):
                 usr_msg = f'{instruction}\n\nQuestion: {usr_msg}'
@@ -305,17 +364,31 @@ def parse_messages(messages, functions):
     return query, history, system
 
 
+_REACT_TAG_RE = re.compile(r'\n(?:(Action|Action Input|Observation):|Final Answer: )')
+
+
 def parse_response(response):
     func_name, func_args = '', ''
-    i = response.find('\nAction:')
-    j = response.find('\nAction Input:')
-    k = response.find('\nObservation:')
+    # Locate all ReAct tags in a single pass: the first `Action`, `Action Input` and
+    # `Observation`, and the last `Final Answer`.
+    tag_pos, z = {}, -1
+    for match in _REACT_TAG_RE.finditer(response):
+        tag = match.group(1)
+        if tag is None:
+            z = match.start()
+        elif tag not in tag_pos:
+            tag_pos[tag] = match.start()
+    i = tag_pos.get('Action', -1)
+    j = tag_pos.get('Action Input', -1)
+    k = tag_pos.get('Observation', -1)
     if 0 <= i < j:  # If the text has `Action` and `Action input`,
         if k < j:  # but does not contain `Observation`,
             # then it is likely that `Observation` is omitted by the LLM,
             # because the output text may have discarded the stop word.
             response = response.rstrip() + '\nObservation:'  # Add it back.
-        k = response.find('\nObservation:')
+            if k < 0:
+                k = len(response) - len('\nObservation:')
+            z = response.rfind('\nFinal Answer: ')
         func_name = response[i + len('\nAction:'):j].strip()
         func_args = response[j + len('\nAction Input:'):k].strip()
 
@@ -339,7 +412,6 @@ def parse_response(response):
         )
         return choice_data
 
-    z = response.rfind('\nFinal Answer: ')
     if z >= 0:
         response = response[z + len('\nFinal Answer: '):]
     choice_data = ChatCompletionResponseChoice(
@@ -350,74 +422,368 @@ def parse_response(response):
     return choice_data
 
 
-def model_chat(model, tokenizer, query, history, gen_kwargs, system):
+class PrefixKVCache:
+    """LRU of `DynamicCache` objects keyed by a hash of the conversation they cover."""
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # key -> (cache, token_ids, nbytes)
+        self._total_bytes = 0
+        self._lock = Lock()
+
+    def pop(self, key: str):
+        # Entries are handed out exclusively, `generate` mutates the cache in place.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._total_bytes -= entry[2]
+            return entry[0], entry[1]
+
+    def put(self, key: str, cache: DynamicCache, token_ids: List[int], nbytes: int):
+        if nbytes > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[2]
+            self._entries[key] = (cache, token_ids, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.budget_bytes:
+                _, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_nbytes
+
+
+class PinnedStager:
+    """Copies prompt ids to the GPU through a reusable pinned host buffer on a side stream."""
+
+    def __init__(self, device: torch.device, size: int = 8192):
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self._buffer = torch.empty(size, dtype=torch.long, pin_memory=True)
+        self._copy_done = None
+        self._lock = Lock()
+
+    def to_device(self, input_ids: List[int]) -> torch.Tensor:
+        n = len(input_ids)
+        with self._lock:
+            # The previous async copy must have read the buffer before it is overwritten.
+            if self._copy_done is not None:
+                self._copy_done.synchronize()
+            if n > self._buffer.numel():
+                self._buffer = torch.empty(max(n, 2 * self._buffer.numel()), dtype=torch.long, pin_memory=True)
+            self._buffer.numpy()[:n] = input_ids
+            with torch.cuda.stream(self.stream):
+                device_ids = self._buffer[:n].to(self.device, non_blocking=True)
+                self._copy_done = self.stream.record_event()
+        return device_ids
+
+
+KV_CACHE_BUDGET_BYTES = 2 * 1024 ** 3
+kv_cache = PrefixKVCache(KV_CACHE_BUDGET_BYTES)
+
+# Whether prompts can be tokenized turn by turn with `_tokenize_turn`, set at startup.
+chatml_turns = False
+# Whether KV caches are reused across turns, set at startup.
+kv_cache_reuse = False
+
+# Non-default CUDA stream all generation runs on, so decoding does not serialize
+# against host-to-device copies and other work queued on the default stream.
+gen_stream = None
+h2d_stager = None
+# With --cuda-graphs, the single long-lived thread all generation runs on. `reduce-overhead`
+# keeps its captured CUDA graphs per thread, so generating on per-request threads would recapture.
+gen_executor = None
+
+
+def _conversation_key(messages: List[Dict[str, str]]) -> str:
+    return hashlib.sha1(orjson.dumps(messages)).hexdigest()
+
+
+def _kv_cache_nbytes(model, seq_len: int) -> int:
+    config = model.config
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or num_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // num_heads
+    dtype_bytes = torch.finfo(model.dtype).bits // 8
+    return seq_len * config.num_hidden_layers * 2 * num_kv_heads * head_dim * dtype_bytes
+
+
+def _build_chat_messages(query, history, system):
     messages = [
         {"role": "system", "content": system}
     ]
-    for i, (question, response) in enumerate(history):
-        question = question.lstrip('\n').rstrip()
-        response = response.lstrip('\n').rstrip()
+    for question, response in history:  # stripped by `parse_messages`
         messages.append({"role": "user", "content": question})
         messages.append({"role": "assistant", "content": response})
     messages.append({"role": "user", "content": query})
-    text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True
-    )
-    model_inputs = tokenizer([text], return_tensors='pt').to(model.device)
-    generated_ids = model.generate(model_inputs.input_ids, **gen_kwargs)
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-    ]
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    return response
+    return messages
 
 
-def stream_model_chat(model, tokenizer, query, history, gen_kwargs, system):
-    messages = [
-        {"role": "system", "content": system}
+@lru_cache(maxsize=1024)
+def _tokenize_turn(role: str, content: Optional[str]) -> Tuple[int, ...]:
+    # ChatML turns start and end with special tokens, so tokenizing them one by one gives the
+    # same ids as tokenizing the rendered conversation. `content=None` is the generation prompt.
+    if content is None:
+        text = f'<|im_start|>{role}\n'
+    else:
+        text = f'<|im_start|>{role}\n{content}<|im_end|>\n'
+    return tuple(tokenizer.encode(text, add_special_tokens=False))
+
+
+def _encode_chatml(messages: List[Dict[str, str]]) -> List[int]:
+    input_ids = []
+    for message in messages:
+        input_ids.extend(_tokenize_turn(message['role'], message['content']))
+    input_ids.extend(_tokenize_turn('assistant', None))
+    return input_ids
+
+
+def _supports_chatml_turns(tokenizer) -> bool:
+    """Check that the chat template renders exactly as concatenated ChatML turns."""
+    if '<|im_start|>' not in (tokenizer.chat_template or ''):
+        return False
+    probe = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi, how can I help you?"},
+        {"role": "user", "content": "你好"},
     ]
-    for i, (question, response) in enumerate(history):
-        question = question.lstrip('\n').rstrip()
-        response = response.lstrip('\n').rstrip()
-        messages.append({"role": "user", "content": question})
-        messages.append({"role": "assistant", "content": response})
-    messages.append({"role": "user", "content": query})
+    text = tokenizer.apply_chat_template(probe, tokenize=False, add_generation_prompt=True)
+    return tokenizer.encode(text) == _encode_chatml(probe)
+
 
+def _encode_messages(tokenizer, messages: List[Dict[str, str]]) -> List[int]:
+    if chatml_turns:
+        return _encode_chatml(messages)
     text = tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True
     )
-    model_inputs = tokenizer([text], return_tensors='pt').to(model.device)
-    gen_kwargs['inputs'] = model_inputs.input_ids
+    # Single sequence, `encode` skips the BatchEncoding and attention mask a batch call builds.
+    return tokenizer.encode(text)
+
+
+def _to_device(model, input_ids: List[int]) -> torch.Tensor:
+    if h2d_stager is None:
+        return torch.tensor(input_ids, device=model.device)
+    return h2d_stager.to_device(input_ids)
+
+
+def _generation_context(inputs: torch.Tensor):
+    if gen_stream is None:
+        return nullcontext()
+    # Inputs were copied on the staging stream, make sure they landed before decoding reads them.
+    gen_stream.wait_stream(h2d_stager.stream)
+    inputs.record_stream(gen_stream)
+    return torch.cuda.stream(gen_stream)
+
+
+def _prepare_gen_kwargs(model, tokenizer, messages, gen_kwargs):
+    input_ids = _encode_messages(tokenizer, messages)
+    gen_kwargs['inputs'] = _to_device(model, input_ids).unsqueeze(0)
+    gen_kwargs['return_dict_in_generate'] = True
+    if not kv_cache_reuse:
+        return gen_kwargs
+
+    # Reuse the KV cache of the previous turn, `generate` only runs prefill over the uncached suffix.
+    past_key_values = DynamicCache()
+    cached = kv_cache.pop(_conversation_key(messages[:-1]))
+    if cached is not None:
+        cache, cached_ids = cached
+        # At least one token must be left for the forward pass that produces the first logits.
+        max_prefix_len = min(len(cached_ids), len(input_ids) - 1)
+        prefix_len = 0
+        while prefix_len < max_prefix_len and cached_ids[prefix_len] == input_ids[prefix_len]:
+            prefix_len += 1
+        if prefix_len > 0:
+            cache.crop(prefix_len)
+            past_key_values = cache
+    gen_kwargs['past_key_values'] = past_key_values
+    gen_kwargs['use_cache'] = True
+    return gen_kwargs
+
+
+def _generate(model, tokenizer, messages, gen_kwargs):
+    with _generation_context(gen_kwargs['inputs']):
+        outputs = model.generate(**gen_kwargs)
+        input_len = gen_kwargs['inputs'].shape[1]
+        response = tokenizer.decode(outputs.sequences[0][input_len:], skip_special_tokens=True)
+
+        cache = outputs.past_key_values
+        # Only keep caches that a later turn can pick up, unused entries would just pin VRAM.
+        if kv_cache_reuse and isinstance(cache, DynamicCache):
+            # The last sampled token is never fed back to the model, so the cache is one token short.
+            cache_len = cache.get_seq_length()
+            key = _conversation_key(messages + [{"role": "assistant", "content": response.lstrip('\n').rstrip()}])
+            kv_cache.put(key, cache, outputs.sequences[0][:cache_len].tolist(), _kv_cache_nbytes(model, cache_len))
+    return response
+
+
+def model_chat(model, tokenizer, query, history, gen_kwargs, system):
+    messages = _build_chat_messages(query, history, system)
+    gen_kwargs = _prepare_gen_kwargs(model, tokenizer, messages, gen_kwargs)
+    return _generate(model, tokenizer, messages, gen_kwargs)
+
+
+def _pad_token_id(model, tokenizer) -> Optional[int]:
+    # Remote-code tokenizers such as Qwen-7B-Chat's set neither a pad nor an eos token.
+    for token_id in (
+        tokenizer.pad_token_id,
+        tokenizer.eos_token_id,
+        model.generation_config.pad_token_id,
+        model.generation_config.eos_token_id,
+    ):
+        if isinstance(token_id, (list, tuple)):
+            token_id = token_id[0] if token_id else None
+        if token_id is not None:
+            return token_id
+    return None
+
+
+def batch_model_chat(model, tokenizer, requests, gen_kwargs):
+    """Generates responses for several (query, history, system) requests in one `generate` call."""
+    pad_token_id = _pad_token_id(model, tokenizer)
+    if len(requests) == 1 or pad_token_id is None:
+        # Without a pad token the prompts cannot be padded to one length, generate them one by one.
+        return [
+            model_chat(model, tokenizer, query, history, dict(gen_kwargs), system)
+            for query, history, system in requests
+        ]
+
+    batch_ids = [_encode_messages(tokenizer, _build_chat_messages(*request)) for request in requests]
+    max_len = max(len(ids) for ids in batch_ids)
+    # Left padding keeps the last prompt token of every row aligned with the first generated one.
+    padded_ids = []
+    for ids in batch_ids:
+        padded_ids.extend([pad_token_id] * (max_len - len(ids)))
+        padded_ids.extend(ids)
+    inputs = _to_device(model, padded_ids).view(len(requests), max_len)
+
+    # `max_length` counts the prompt, padding included here, so turn it into the budget of new
+    # tokens each request would get on its own. Rows are cut to their budget after generation.
+    generation_config = gen_kwargs['generation_config']
+    if generation_config.max_new_tokens is not None:
+        budgets = [generation_config.max_new_tokens] * len(batch_ids)
+    else:
+        budgets = [max(generation_config.max_length - len(ids), 1) for ids in batch_ids]
+
+    with _generation_context(inputs):
+        # Built on the generation stream, which is where `generate` reads the mask.
+        pad_lens = torch.tensor([max_len - len(ids) for ids in batch_ids], device=model.device)
+        attention_mask = (torch.arange(max_len, device=model.device) >= pad_lens[:, None]).long()
+        generated_ids = model.generate(
+            inputs=inputs,
+            attention_mask=attention_mask,
+            pad_token_id=pad_token_id,
+            max_new_tokens=max(budgets),
+            **gen_kwargs,
+        )
+        return [
+            tokenizer.decode(row[max_len:max_len + budget], skip_special_tokens=True)
+            for row, budget in zip(generated_ids, budgets)
+        ]
+
+
+class GenerationBatcher:
+    """Merges concurrent non-streaming requests that share sampling params into one batch."""
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._task = None
+
+    async def submit(self, query, history, system, gen_kwargs) -> str:
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((query, history, system), gen_kwargs, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Requests arriving while a batch is generating are picked up together next round.
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for item in batch:
+                # Generation configs are cached per sampling params, equal params share one object.
+                groups.setdefault(id(item[1]['generation_config']), []).append(item)
+            for group in groups.values():
+                requests = [request for request, _, _ in group]
+                try:
+                    responses = await loop.run_in_executor(
+                        gen_executor, batch_model_chat, model, tokenizer, requests, group[0][1])
+                except Exception as e:
+                    for _, _, future in group:
+                        if not future.done():  # the client may have disconnected
+                            future.set_exception(e)
+                else:
+                    for (_, _, future), response in zip(group, responses):
+                        if not future.done():
+                            future.set_result(response)
+
+
+def stream_model_chat(model, tokenizer, query, history, gen_kwargs, system):
+    messages = _build_chat_messages(query, history, system)
+    gen_kwargs = _prepare_gen_kwargs(model, tokenizer, messages, gen_kwargs)
 
     streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
     gen_kwargs['streamer'] = streamer
-    thread = Thread(target=model.generate, kwargs=gen_kwargs, daemon=True)
-    thread.start()
+    if gen_executor is None:
+        thread = Thread(target=_generate, args=(model, tokenizer, messages, gen_kwargs), daemon=True)
+        thread.start()
+    else:
+        gen_executor.submit(_generate, model, tokenizer, messages, gen_kwargs).add_done_callback(
+            _log_generation_error)
 
     yield from streamer
 
 
+def _log_generation_error(future: Future):
+    # Executor threads keep exceptions in the future, a plain `Thread` would have printed them.
+    exc = future.exception()
+    if exc is not None:
+        logger.opt(exception=exc).error('Streaming generation failed')
+
+
+@lru_cache(maxsize=64)
+def _generation_config(top_k, top_p, temperature, max_length) -> GenerationConfig:
+    # Built once per distinct set of sampling params instead of merging kwargs into a
+    # fresh config on every request. `generate` copies it before applying call kwargs.
+    generation_config = copy.deepcopy(model.generation_config)
+    overrides = dict(top_k=top_k, top_p=top_p, temperature=temperature, max_length=max_length)
+    generation_config.update(**{k: v for k, v in overrides.items() if v is not None})
+    return generation_config
+
+
 @app.post('/v1/chat/completions', response_model=ChatCompletionResponse)
 async def create_chat_completion(request: ChatCompletionRequest):
     global model, tokenizer
 
-    gen_kwargs = {}
-    if request.top_k is not None:
-        gen_kwargs['top_k'] = request.top_k
+    top_k, temperature = request.top_k, None
     if request.temperature is not None:
         if request.temperature < 0.01:
-            gen_kwargs['top_k'] = 1  # greedy decoding
+            top_k = 1  # greedy decoding
         else:
             # Not recommended. Please tune top_p instead.
-            gen_kwargs['temperature'] = request.temperature
-    if request.top_p is not None:
-        gen_kwargs['top_p'] = request.top_p
-    if request.max_length is not None:
-        gen_kwargs['max_length'] = request.max_length
+            temperature = request.temperature
+    gen_kwargs = {
+        'generation_config': _generation_config(top_k, request.top_p, temperature, request.max_length),
+    }
 
     stop_words = add_extra_stop_words(request.stop)
     if request.functions:
@@ -441,14 +807,7 @@ async def create_chat_completion(request: ChatCompletionRequest):
                             system=system)
         return StreamingResponse(generate, media_type='text/event-stream')
 
-    response = model_chat(
-        model,
-        tokenizer,
-        query,
-        history,
-        gen_kwargs=gen_kwargs,
-        system=system
-    )
+    response = await batcher.submit(query, history, system, gen_kwargs)
     logger.debug(f'*** history begin ***\n{history}\n*** history end ***\n'
                  f'question: {query}\nresponse: {response}\n')
     _gc()
@@ -467,18 +826,26 @@ async def create_chat_completion(request: ChatCompletionRequest):
                                   object='chat.completion')
 
 
-def dictify(data: BaseModel) -> Dict[str, Any]:
-    try:  # pydantic v2
+# Pick the pydantic API once at import instead of catching AttributeError on every chunk.
+if PYDANTIC_V2:
+    def dictify(data: BaseModel) -> Dict[str, Any]:
         return data.model_dump(exclude_unset=True)
-    except AttributeError:  # pydantic v1
+
+    def jsonify(data: BaseModel) -> str:
+        return data.model_dump_json(exclude_unset=True)
+else:
+    def dictify(data: BaseModel) -> Dict[str, Any]:
         return data.dict(exclude_unset=True)
 
+    def jsonify(data: BaseModel) -> str:
+        return orjson.dumps(data.dict(exclude_unset=True)).decode()
 
-def jsonify(data: BaseModel) -> str:
-    try:  # pydantic v2
-        return json.dumps(data.model_dump(exclude_unset=True), ensure_ascii=False)
-    except AttributeError:  # pydantic v1
-        return data.json(exclude_unset=True, ensure_ascii=False)
+
+# Streamed tokens are coalesced into one SSE chunk until either limit is reached.
+STREAM_FLUSH_CHARS = 16
+STREAM_FLUSH_INTERVAL = 0.02  # seconds
+
+_STREAM_END = object()
 
 
 async def apredict(
@@ -497,7 +864,13 @@ async def apredict(
                                    object='chat.completion.chunk')
     yield jsonify(chunk)
 
-    stop_words = [x for x in stop_words if x]
+    # Per-token chunks only differ in their content, so render the envelope once instead of
+    # building and serializing three pydantic models per token. Matches `jsonify(chunk)` output.
+    chunk_prefix = ('{"model":%s,"object":"chat.completion.chunk",'
+                    '"choices":[{"index":0,"delta":{"content":' % orjson.dumps(model_id).decode())
+    chunk_suffix = '},"finish_reason":null}]}'
+
+    stop_matcher = StopWordsMatcher(stop_words)
     response_generator = stream_model_chat(
         model,
         tokenizer,
@@ -506,18 +879,45 @@ async def apredict(
         gen_kwargs,
         system
     )
-    for token_output in response_generator:
-        # Check if any stop word is in the token output
-        if any(stop_word in token_output for stop_word in stop_words):
+    loop = asyncio.get_running_loop()
+    buffer = ''
+    flush_at = 0.0
+    next_token = None
+    while True:
+        # `TextIteratorStreamer` blocks on a queue, so pull from it in a worker thread
+        # instead of stalling the event loop for every token.
+        if next_token is None:
+            next_token = loop.run_in_executor(None, next, response_generator, _STREAM_END)
+        if buffer:
+            # Buffered text is sent after at most STREAM_FLUSH_INTERVAL, even if no token follows.
+            # The shield keeps a timed out wait from cancelling the pending read of the next token.
+            try:
+                token_output = await asyncio.wait_for(asyncio.shield(next_token), flush_at - loop.time())
+            except asyncio.TimeoutError:
+                yield chunk_prefix + orjson.dumps(buffer).decode() + chunk_suffix
+                buffer = ''
+                continue
+        else:
+            token_output = await next_token
+        next_token = None
+        if token_output is _STREAM_END:
+            break
+
+        # Cut the output right before a stop word, even if it spans several tokens
+        token_output, stopped = stop_matcher.feed(token_output)
+        if token_output and not buffer:
+            flush_at = loop.time() + STREAM_FLUSH_INTERVAL
+        buffer += token_output
+        if stopped:
             break
 
-        # Send the current token as part of the response
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0, delta=DeltaMessage(content=token_output), finish_reason=None)
-        chunk = ChatCompletionResponse(model=model_id,
-                                       choices=[choice_data],
-                                       object='chat.completion.chunk')
-        yield jsonify(chunk)
+        # Send the buffered tokens once enough text has accumulated
+        if len(buffer) >= STREAM_FLUSH_CHARS:
+            yield chunk_prefix + orjson.dumps(buffer).decode() + chunk_suffix
+            buffer = ''
+    buffer += stop_matcher.flush()
+    if buffer:
+        yield chunk_prefix + orjson.dumps(buffer).decode() + chunk_suffix
 
     choice_data = ChatCompletionResponseStreamChoice(index=0,
                                                      delta=DeltaMessage(),
@@ -555,25 +955,79 @@ def _get_args():
         help='Demo server name. Default: 127.0.0.1, which is only visible from the local computer.'
              ' If you want other computers to access your server, use 0.0.0.0 instead.',
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of server processes, each loads its own model and is pinned to one GPU '
+             '(round-robin). Default to %(default)r',
+    )
+    parser.add_argument(
+        '--attn-implementation',
+        type=str,
+        default=None,
+        choices=['eager', 'sdpa', 'flash_attention_2'],
+        help='Attention kernel, e.g. flash_attention_2 (requires flash-attn). Default lets transformers choose.',
+    )
+    parser.add_argument(
+        '--torch-compile',
+        action='store_true',
+        help='Compile the model forward with torch.compile.',
+    )
+    parser.add_argument(
+        '--quant',
+        type=str,
+        default='none',
+        choices=['none', 'int8', 'int4'],
+        help='Quantize model weights at load time with bitsandbytes, default to %(default)r',
+    )
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=8,
+        help='Max number of concurrent non-stream requests generated in one batch, default to %(default)r',
+    )
+    parser.add_argument(
+        '--batch-wait-ms',
+        type=float,
+        default=5.0,
+        help='How long to wait for more requests to join a batch, default to %(default)r',
+    )
     parser.add_argument(
         '--disable-gc',
         action='store_true',
         help='Disable GC after each response generated.',
     )
+    parser.add_argument(
+        '--disable-kv-cache',
+        action='store_true',
+        help='Disable reusing the KV cache of previous turns in multi-turn chats. '
+             'Reuse is only enabled for models that support transformers cache classes.',
+    )
+    parser.add_argument(
+        '--cuda-graphs',
+        action='store_true',
+        help='Capture decode steps in CUDA graphs with a static KV cache. '
+             'Disables KV cache reuse across turns and runs all generation on a single thread.',
+    )
 
     args = parser.parse_args()
     return args
 
 
-if __name__ == '__main__':
-    args = _get_args()
+def _setup(cli_args):
+    """Loads the tokenizer and model into module globals and configures the app."""
+    global args, tokenizer, model, chatml_turns, kv_cache_reuse, batcher, gen_stream, h2d_stager, gen_executor
+    args = cli_args
 
     tokenizer = AutoTokenizer.from_pretrained(
         args.checkpoint_path,
         trust_remote_code=True,
-        resume_download=True,
     )
 
+    chatml_turns = _supports_chatml_turns(tokenizer)
+    batcher = GenerationBatcher(args.max_batch_size, args.batch_wait_ms / 1000)
+
     if args.api_auth:
         app.add_middleware(
             BasicAuthMiddleware,
@@ -586,17 +1040,97 @@ if __name__ == '__main__':
     else:
         device_map = 'auto'
 
+    model_kwargs = {}
+    if args.attn_implementation:
+        model_kwargs['attn_implementation'] = args.attn_implementation
+    if not args.cpu_only and torch.cuda.is_available():
+        # FlashAttention-2 only runs in half precision, bf16 avoids fp16 overflow where supported.
+        model_kwargs['torch_dtype'] = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    if args.quant != 'none':
+        if args.cpu_only:
+            raise ValueError('Error, --quant requires a GPU and cannot be used with --cpu-only')
+        logger.info(f'Quantizing model weights to {args.quant}')
+        if args.quant == 'int8':
+            model_kwargs['quantization_config'] = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            model_kwargs['quantization_config'] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type='nf4',
+                bnb_4bit_compute_dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16,
+            )
+
     model = AutoModelForCausalLM.from_pretrained(
         args.checkpoint_path,
         device_map=device_map,
         trust_remote_code=True,
-        resume_download=True,
+        **model_kwargs,
     ).eval()
-
-    model.generation_config = GenerationConfig.from_pretrained(
-        args.checkpoint_path,
-        trust_remote_code=True,
-        resume_download=True,
+    if torch.cuda.is_available() and model.device.type == 'cuda':
+        gen_stream = torch.cuda.Stream(device=model.device)
+        h2d_stager = PinnedStager(model.device)
+
+    if args.cuda_graphs:
+        # `_supports_static_cache` on newer transformers, `_setup_cache` on 4.39.
+        if not (getattr(model, '_supports_static_cache', False) or callable(getattr(model, '_setup_cache', None))):
+            raise ValueError(
+                f'Error, --cuda-graphs requires a model that supports a static KV cache, '
+                f'{args.checkpoint_path} does not'
+            )
+        # A static cache keeps every decode step the same shape, so `reduce-overhead`
+        # replays a captured CUDA graph per token instead of launching each kernel.
+        model.generation_config.cache_implementation = 'static'
+        model.forward = torch.compile(model.forward, mode='reduce-overhead', fullgraph=True)
+        gen_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generate')
+    elif args.torch_compile:
+        # Fuses elementwise ops around attention and MLP. Prompt lengths vary per request,
+        # so compile with dynamic shapes to avoid a recompilation for every new length.
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    # Remote-code models such as Qwen-7B-Chat keep legacy tuple caches and cannot take a `DynamicCache`,
+    # and `DynamicCache.crop`, used to trim a reused cache, is missing in older transformers.
+    kv_cache_reuse = (
+        not args.disable_kv_cache
+        and not args.cuda_graphs
+        and getattr(model, '_supports_cache_class', False)
+        and hasattr(DynamicCache, 'crop')
     )
+    if not args.disable_kv_cache and not args.cuda_graphs and not kv_cache_reuse:
+        logger.info('Model or transformers version does not support cache reuse, '
+                    'KV cache reuse across turns is disabled')
+
+
+def _serve_worker(cli_args, sockets, visible_devices: Optional[str]):
+    # Runs in a spawned process. Restricting the visible GPUs must happen before CUDA is initialized.
+    if visible_devices is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices
+    _setup(cli_args)
+    config = uvicorn.Config(app, host=cli_args.server_name, port=cli_args.server_port)
+    uvicorn.Server(config).run(sockets=sockets)
+
 
-    uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
+if __name__ == '__main__':
+    args = _get_args()
+
+    if args.workers <= 1:
+        _setup(args)
+        uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
+    else:
+        # Every worker loads its own model copy and accepts connections on the shared socket.
+        # With several GPUs, workers are spread round-robin, one GPU each.
+        sock = uvicorn.Config(app, host=args.server_name, port=args.server_port).bind_socket()
+        devices = []
+        if not args.cpu_only and torch.cuda.is_available():
+            visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+            devices = visible.split(',') if visible else [str(i) for i in range(torch.cuda.device_count())]
+        ctx = multiprocessing.get_context('spawn')
+        workers = [
+            ctx.Process(
+                target=_serve_worker,
+                args=(args, [sock], devices[i % len(devices)] if devices else None),
+            )
+            for i in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
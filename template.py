@@ -6,7 +6,7 @@ Conversation类是一个包含以下字段的数据类:
 
 name:对话模板的名称。
 system_prompt:设置上下文的初始系统提示符。
-messages:消息序列的列表，其中每个序列是一对[查询，回答]。
+messages:扁平的消息列表，依次为[查询1，回答1，查询2，回答2，...]。
 roles:说话者的角色，通常是“USER”、“ASSISTANT”。
 提示:每个会话回合使用的提示格式。
 sep:匝间使用的分隔字符串。
@@ -22,13 +22,90 @@ get_conv_template函数根据提供的名称从conv_templates字典中检索特
 此代码可能用于与不同语言模型交互的大型系统中。通过定义和注册对话模板，系统可以轻松地为各种模型格式化提示并管理对话历史。这些模板处理不同的格式需求，例如演讲者角色、提示符、分隔符和停止令牌，从而更容易一致地使用多个模型。
 """
 
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Sequence
+import sys
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import chain
+from types import MappingProxyType
+from typing import Any, Callable, Optional, List, Dict, Iterator, Sequence
+
+__all__ = ['Conversation', 'CONV_TEMPLATES', 'register_conv_template', 'get_conv_template', 'clear_prompt_cache']
+
+
+def _iter_parts(
+        system_prefix: str,
+        messages: Sequence[str],
+        pre: str,
+        post: str,
+        sep: str
+) -> Iterator[str]:
+    """Yields the pieces of a prompt from flat [query, response, ...] messages and the template split around `{query}`."""
+    yield system_prefix
+    for i in range(0, len(messages), 2):
+        if i != 0:
+            yield sep
+        yield pre
+        yield messages[i]
+        yield post
+        # The last response is usually empty, as the prompt is about to be generated from
+        if messages[i + 1]:
+            yield messages[i + 1]
+
+
+def _join_prompt(
+        system_prefix: str,
+        messages: Sequence[str],
+        pre: str,
+        post: str,
+        sep: str
+) -> str:
+    """Renders a prompt from flat [query, response, ...] messages."""
+    return "".join(_iter_parts(system_prefix, messages, pre, post, sep))
+
+
+# Cached, since the same conversation prefix is often rendered repeatedly
+_render_prompt = lru_cache(maxsize=1024)(_join_prompt)
+
+
+def clear_prompt_cache():
+    """Clear the cache of rendered prompts."""
+    _render_prompt.cache_clear()
+
+
+_DIALOG_FORMATTER_SRC = """\
+def format_dialog(messages, system_prefix={system_prefix!r}):
+    convs = []
+    prefix = system_prefix
+    for i in range(0, len(messages), 2):
+        convs.append(prefix + {pre!r} + messages[i] + {post!r})
+        convs.append(messages[i + 1])
+        prefix = {sep!r}
+    return convs
+"""
+
+
+@lru_cache(maxsize=None)
+def _compile_dialog_formatter(
+        system_prefix: str,
+        pre: str,
+        post: str,
+        sep: str
+) -> Callable[..., List[str]]:
+    """Generates a dialog formatter with the template pieces baked in as constants."""
+    namespace: Dict[str, Any] = {}
+    src = _DIALOG_FORMATTER_SRC.format(system_prefix=system_prefix, pre=pre, post=post, sep=sep)
+    exec(compile(src, "<conv_template>", "exec"), namespace)
+    return namespace["format_dialog"]
+
+
+# Fields the precomputed template pieces are derived from
+_TEMPLATE_FIELDS = frozenset(("system_prompt", "prompt", "sep"))
 
-__all__ = ['Conversation', 'register_conv_template', 'get_conv_template']
+# `slots` requires Python 3.10+, older interpreters keep the per-instance __dict__
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
 
-@dataclass
+@dataclass(eq=False, repr=False, **_DATACLASS_SLOTS)
 class Conversation:
     """A class that manages prompt templates and keeps all conversation history."""
 
@@ -36,8 +113,8 @@ class Conversation:
     name: str
     # The system prompt
     system_prompt: str
-    # All messages. format: list of [question, answer]
-    messages: Optional[List[Sequence[str]]]
+    # All messages, flattened. format: [question_1, answer_1, question_2, answer_2, ...]
+    messages: List[str]
     # The roles of the speakers
     roles: Optional[Sequence[str]]
     # Conversation prompt
@@ -46,6 +123,73 @@ class Conversation:
     sep: str
     # Stop token, default is tokenizer.eos_token
     stop_str: Optional[str] = "</s>"
+    # Default system prompt with its separator, empty if there is no system prompt
+    _system_prefix: str = field(init=False, repr=False, compare=False)
+    # Prompt text before and after `{query}`
+    _pre: str = field(init=False, repr=False, compare=False)
+    _post: str = field(init=False, repr=False, compare=False)
+    # Dialog formatter specialized for this template, generated at registration
+    _format_dialog: Optional[Callable[..., List[str]]] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Interned names let registry lookups with literal names match by identity, and the short
+        # separators and stop strings shared by many templates become single objects
+        self.name = sys.intern(self.name)
+        self.sep = sys.intern(self.sep)
+        if self.stop_str:
+            self.stop_str = sys.intern(self.stop_str)
+        self._update_template()
+
+    def __setattr__(self, name, value):
+        if name == "messages" and value and not isinstance(value[0], str):
+            # Also accept the list of [question, answer] pairs
+            value = list(chain.from_iterable(value))
+        # Zero-argument super() does not work in a slotted dataclass, which is a rebuilt class
+        object.__setattr__(self, name, value)
+        # The derived template pieces only exist once __post_init__ has run
+        if name in _TEMPLATE_FIELDS and hasattr(self, "_pre"):
+            self._update_template()
+
+    def _update_template(self):
+        """Precompute the system prefix and the prompt split around `{query}` from the template fields."""
+        object.__setattr__(
+            self, "_system_prefix", self.system_prompt + self.sep if self.system_prompt else ""
+        )
+        # Split the prompt around `{query}` once, so formatting a turn is plain concatenation
+        idx = self.prompt.find("{query}")
+        if idx < 0:
+            raise ValueError(f"Prompt of conversation template {self.name!r} has no {{query}} placeholder")
+        pre, post = self.prompt[:idx], self.prompt[idx + len("{query}"):]
+        object.__setattr__(self, "_pre", pre.replace("{{", "{").replace("}}", "}"))
+        object.__setattr__(self, "_post", post.replace("{{", "{").replace("}}", "}"))
+        if self._format_dialog is not None:
+            self._specialize()
+
+    def __repr__(self):
+        return f"<Conversation {self.name}>"
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__dataclass_fields__}
+        # Generated functions cannot be pickled, only record whether to regenerate one
+        state["_format_dialog"] = self._format_dialog is not None
+        return state
+
+    def __setstate__(self, state):
+        specialized = state.pop("_format_dialog")
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_format_dialog", None)
+        if specialized:
+            self._specialize()
+
+    def _specialize(self):
+        """Replace the generic dialog formatting with one generated for this template."""
+        self._format_dialog = _compile_dialog_formatter(self._system_prefix, self._pre, self._post, self.sep)
+
+    @property
+    def messages_as_pairs(self) -> List[List[str]]:
+        """Returns the history as a list of [question, answer]."""
+        return [self.messages[i:i + 2] for i in range(0, len(self.messages), 2)]
 
     def get_prompt(
             self,
@@ -55,7 +199,34 @@ class Conversation:
         """
         Returns a string containing prompt without response.
         """
-        return "".join(self._format_example(messages, system_prompt))
+        flat = tuple(chain.from_iterable(messages)) if messages else tuple(self.messages)
+        if not flat:
+            return ""
+        return _render_prompt(
+            system_prompt + self.sep if system_prompt else self._system_prefix,
+            flat,
+            self._pre,
+            self._post,
+            self.sep,
+        )
+
+    def get_prompts_batch(
+            self,
+            batch: List[List[Sequence[str]]],
+            system_prompt: Optional[str] = ""
+    ) -> List[str]:
+        """
+        Returns a list of prompts, one for each conversation in the batch, same as calling `get_prompt` on each.
+        """
+        system_prefix = system_prompt + self.sep if system_prompt else self._system_prefix
+        pre, post, sep = self._pre, self._post, self.sep
+        default_messages = self.messages
+        prompts = []
+        for messages in batch:
+            flat = tuple(chain.from_iterable(messages)) if messages else default_messages
+            # Batches are mostly distinct conversations, so bypass the prompt cache
+            prompts.append(_join_prompt(system_prefix, flat, pre, post, sep) if flat else "")
+        return prompts
 
     def get_dialog(
             self,
@@ -72,33 +243,62 @@ class Conversation:
             messages: Optional[List[Sequence[str]]] = None,
             system_prompt: Optional[str] = ""
     ) -> List[str]:
-        system_prompt = system_prompt or self.system_prompt
-        system_prompt = system_prompt + self.sep if system_prompt else ""  # add separator for non-empty system prompt
-        messages = messages or self.messages
-        convs = []
-        for turn_idx, [user_query, bot_resp] in enumerate(messages):
-            if turn_idx == 0:
-                convs.append(system_prompt + self.prompt.format(query=user_query))
-                convs.append(bot_resp)
-            else:
-                convs.append(self.sep + self.prompt.format(query=user_query))
-                convs.append(bot_resp)
-        return convs
+        # add separator for non-empty system prompt
+        system_prefix = system_prompt + self.sep if system_prompt else self._system_prefix
+        flat = tuple(chain.from_iterable(messages)) if messages else self.messages
+        if self._format_dialog is not None:
+            return self._format_dialog(flat, system_prefix)
+        return list(self._iter_dialog(flat, system_prefix))
+
+    def _iter_dialog(self, messages: Sequence[str], system_prefix: str) -> Iterator[str]:
+        """Yields the formatted query and the response of each turn in flat messages."""
+        # Bind the template pieces once instead of looking them up on every turn
+        sep, pre, post = self.sep, self._pre, self._post
+        prefix = system_prefix
+        for i in range(0, len(messages), 2):
+            yield prefix + pre + messages[i] + post
+            yield messages[i + 1]
+            prefix = sep
 
     def append_message(self, query: str, answer: str):
         """Append a new message."""
-        self.messages.append([query, answer])
+        self.messages.extend((query, answer))
 
 
 # A global registry for all conversation templates
 conv_templates: Dict[str, Conversation] = {}
+# Read-only view of the registry for lookups
+CONV_TEMPLATES = MappingProxyType(conv_templates)
 
 
 def register_conv_template(template: Conversation):
     """Register a new conversation template."""
+    template._specialize()
     conv_templates[template.name] = template
 
 
+# System prompts shared by several templates, defined once so the templates reference the same objects
+_SYS_HELPFUL = sys.intern(
+    "A chat between a curious user and an artificial intelligence assistant. "
+    "The assistant gives helpful, detailed, and polite answers to the user's questions."
+)
+_SYS_HELPFUL_HUMAN = sys.intern(
+    "A chat between a curious human and an artificial intelligence assistant. "
+    "The assistant gives helpful, detailed, and polite answers to the human's questions."
+)
+_SYS_LLAMA2 = sys.intern(
+    "<<SYS>>\nYou are a helpful, respectful and honest assistant. "
+    "Always answer as helpfully as possible, while being safe. "
+    "Your answers should not include any harmful, unethical, racist, sexist, "
+    "toxic, dangerous, or illegal content. "
+    "Please ensure that your responses are socially unbiased and positive in nature.\n\n"
+    "If a question does not make any sense, or is not factually coherent, "
+    "explain why instead of answering something not correct. "
+    "If you don't know the answer to a question, please don't share false information.\n<</SYS>>\n\n"
+)
+_SYS_LLAMA2_ZH = sys.intern("[INST] <<SYS>>\nYou are a helpful assistant. 你是一个乐于助人的助手。\n<</SYS>>\n\n [/INST]")
+
+
 """Vicuna v1.1 template
 Supports: https://huggingface.co/lmsys/vicuna-7b-delta-v1.1
           https://huggingface.co/lmsys/vicuna-13b-delta-v1.1
@@ -106,8 +306,7 @@ Supports: https://huggingface.co/lmsys/vicuna-7b-delta-v1.1
 register_conv_template(
     Conversation(
         name="vicuna",
-        system_prompt="A chat between a curious user and an artificial intelligence assistant. "
-                      "The assistant gives helpful, detailed, and polite answers to the user's questions.",
+        system_prompt=_SYS_HELPFUL,
         messages=[],
         roles=("USER", "ASSISTANT"),
         prompt="USER: {query} ASSISTANT:",
@@ -244,8 +443,7 @@ register_conv_template(
 register_conv_template(
     Conversation(
         name="phoenix",
-        system_prompt="A chat between a curious human and an artificial intelligence assistant. "
-                      "The assistant gives helpful, detailed, and polite answers to the human's questions.\n\n",
+        system_prompt=_SYS_HELPFUL_HUMAN + "\n\n",
         messages=[],
         roles=("Human", "Assistant"),
         prompt="Human: <s>{query}</s>Assistant: ",
@@ -274,8 +472,7 @@ Supports: https://huggingface.co/qhduan/aquilachat-7b
 register_conv_template(
     Conversation(
         name="aquila",
-        system_prompt="A chat between a curious human and an artificial intelligence assistant. "
-                      "The assistant gives helpful, detailed, and polite answers to the human's questions.",
+        system_prompt=_SYS_HELPFUL_HUMAN,
         messages=[],
         roles=("Human", "Assistant"),
         prompt="Human: {query}###Assistant:",
@@ -324,16 +521,7 @@ reference: https://github.com/facebookresearch/llama/blob/cfc3fc8c1968d390eb830e
 register_conv_template(
     Conversation(
         name="llama2",
-        system_prompt=(
-            "<<SYS>>\nYou are a helpful, respectful and honest assistant. "
-            "Always answer as helpfully as possible, while being safe. "
-            "Your answers should not include any harmful, unethical, racist, sexist, "
-            "toxic, dangerous, or illegal content. "
-            "Please ensure that your responses are socially unbiased and positive in nature.\n\n"
-            "If a question does not make any sense, or is not factually coherent, "
-            "explain why instead of answering something not correct. "
-            "If you don't know the answer to a question, please don't share false information.\n<</SYS>>\n\n"
-        ),
+        system_prompt=_SYS_LLAMA2,
         messages=[],
         roles=("[INST]", "[/INST]"),
         prompt="[INST] {query} [/INST]",
@@ -375,7 +563,7 @@ Supports: https://huggingface.co/ziqingyang/chinese-alpaca-2-7b
 register_conv_template(
     Conversation(
         name="llama2-zh",
-        system_prompt="[INST] <<SYS>>\nYou are a helpful assistant. 你是一个乐于助人的助手。\n<</SYS>>\n\n [/INST]",
+        system_prompt=_SYS_LLAMA2_ZH,
         messages=[],
         roles=("[INST]", "[/INST]"),
         prompt="[INST] {query} [/INST]",
@@ -458,7 +646,7 @@ register_conv_template(
         ),
         messages=[],
         roles=("### Instruction", "### Response"),
-        prompt="### Instruction:\n{{content}}\n### Response:\n",
+        prompt="### Instruction:\n{query}\n### Response:\n",
         sep="\n",
         stop_str="<|EOT|>",
     )
@@ -534,4 +722,4 @@ register_conv_template(
 
 def get_conv_template(name: str) -> Conversation:
     """Get a conversation template."""
-    return conv_templates[name]
+    return CONV_TEMPLATES[name]